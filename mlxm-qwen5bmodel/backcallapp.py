@@ -2,10 +2,20 @@
 import threading
 import uvicorn
 import webview
-from backend import app as fastapi_app
+from backend.app import app as fastapi_app
 
 def start_backend():
-    uvicorn.run(fastapi_app, host="127.0.0.1", port=8000)
+    # One worker: the model can't be duplicated in RAM per process.
+    uvicorn.run(
+        fastapi_app,
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=1,
+        log_level="warning",
+        access_log=False,
+    )
 
 if __name__ == "__main__":
     threading.Thread(target=start_backend, daemon=True).start()
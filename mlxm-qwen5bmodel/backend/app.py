@@ -1,10 +1,38 @@
 import os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from mlx_lm import load, generate
+import asyncio
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Annotated, Any, Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import msgspec
+import mlx.core as mx
+from mlx_lm.utils import load
+from mlx_lm.generate import generate, stream_generate
+try:
+    from mlx_lm.generate import BatchGenerator
+except ImportError:  # older mlx_lm without batched decoding
+    BatchGenerator = None
+from mlx_lm.models.cache import make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache
 from fastapi.middleware.cors import CORSMiddleware
 
-MODEL_NAME = "mlx-community/Qwen3-4B-Thinking-2507-5bit"
+# 4-bit group-quant: decode is memory-bandwidth bound, so fewer weight bytes -> more tok/s.
+# Set QWEN_MODEL=mlx-community/Qwen3-4B-Thinking-2507-5bit for the higher-precision build.
+MODEL_NAME = os.environ.get("QWEN_MODEL", "mlx-community/Qwen3-4B-Thinking-2507-4bit")
+# Optional KV-cache quantization (e.g. QWEN_KV_BITS=8): once a context grows past
+# KV_QUANT_START tokens, attention reads fewer KV bytes per decoded token.
+# Only the single-stream path (session requests) uses it; BatchGenerator has no kv_bits.
+KV_BITS = int(os.environ["QWEN_KV_BITS"]) if os.environ.get("QWEN_KV_BITS") else None
+KV_QUANT_START = 5000    # passed explicitly: some mlx_lm versions default quantized_kv_start to 0
+MAX_BATCH_SIZE = 4       # prompts decoded together; bound by KV memory (~3 GB weights + KV * B)
+MAX_BATCH_DELAY = 0.05   # seconds to wait for more requests before starting a batch
+MAX_CACHED_SESSIONS = 4  # per-conversation KV caches kept for prefix reuse (LRU)
+MAX_ACTIVE_REQUESTS = MAX_BATCH_SIZE * 4  # admitted (queued + decoding); later requests wait
+MAX_CACHED_PROMPTS = 64  # templated+tokenized histories kept (LRU)
 
 app = FastAPI(title="Qwen MLX Chat API", version="1.0")
 
@@ -12,52 +40,392 @@ app = FastAPI(title="Qwen MLX Chat API", version="1.0")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:8501"],  # Streamlit default port
-    allow_methods=["GET"],
+    # pywebview serves frontend/index.html from a local server on a random port
+    allow_origin_regex=r"http://(localhost|127\.0\.0\.1):\d+",
+    allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
 
-class ChatRequest(BaseModel):
+class ChatRequest(msgspec.Struct):
     messages: list[dict]
-    max_new_tokens: int = 1024
+    max_new_tokens: Annotated[int, msgspec.Meta(ge=1)] = 1024
+    # Loosely typed so clients sending e.g. "stream": 1 or a numeric session id
+    # keep working; _parse_chat_request normalizes them.
+    stream: Any = False
+    session_id: Any = None
+
+@dataclass
+class Job:
+    prompt: object
+    max_tokens: int
+    session_id: Optional[str] = None
+    resp_q: asyncio.Queue = field(default_factory=asyncio.Queue)
+    cancel: threading.Event = field(default_factory=threading.Event)
 
 model = None
 tokenizer = None
 
+# Single pinch-point for inference: the background server_loop owns the model
+# and serves Jobs pulled off this queue.
+app.model_queue = asyncio.Queue()
+app.model_ready = asyncio.Event()   # set once the lazily-loaded weights are materialized
+app.request_slots = asyncio.Semaphore(MAX_ACTIVE_REQUESTS)
+
+# session_id -> (token ids held in the KV cache, prompt cache); only touched by the worker
+SESSION_CACHE: "OrderedDict[str, tuple[list[int], list]]" = OrderedDict()
+
+# hash of the message list -> prompt token ids; filled from executor threads, hence the lock
+PROMPT_CACHE: "OrderedDict[tuple, list[int]]" = OrderedDict()
+PROMPT_CACHE_LOCK = threading.Lock()
+
 @app.on_event("startup")
 async def startup_event():
     global model, tokenizer
     try:
         print(f"🚀 Loading model: {MODEL_NAME}")
-        model, tokenizer = load(MODEL_NAME)
-        print("✅ Model loaded and ready.")
+        # lazy=True memory-maps the safetensors; weights are paged in by the worker
+        # so the HTTP server is up immediately.
+        model, tokenizer = load(MODEL_NAME, lazy=True)
+        _cache_chat_template(tokenizer)
+        print("✅ Model mapped; warming up in the background.")
     except Exception as e:
         print(f"❌ Error loading model: {e}")
         raise e
+    app.server_loop_task = asyncio.create_task(server_loop(app.model_queue))
+
+def _cache_chat_template(tok):
+    """Compile the Jinja chat template once instead of on every apply_chat_template call."""
+    hf_tok = getattr(tok, "_tokenizer", tok)  # unwrap mlx_lm's TokenizerWrapper
+    compile_fn = getattr(hf_tok, "_compile_jinja_template", None)
+    # Newer transformers already memoize this at module level.
+    if compile_fn is not None and not hasattr(compile_fn, "cache_info"):
+        hf_tok._compile_jinja_template = lru_cache(maxsize=4)(compile_fn)
+
+def _session_cache(session_id: str, prompt_ids: list[int]):
+    """Return (prompt_cache, n_reused) reusing the session's KV for the shared token prefix."""
+    entry = SESSION_CACHE.pop(session_id, None)
+    if entry is not None:
+        cached_ids, cache = entry
+        common = 0
+        for a, b in zip(cached_ids, prompt_ids):
+            if a != b:
+                break
+            common += 1
+        common = min(common, len(prompt_ids) - 1)  # always prefill at least one token
+        excess = len(cached_ids) - common
+        if excess == 0 or (can_trim_prompt_cache(cache) and trim_prompt_cache(cache, excess) == excess):
+            return cache, common
+    return make_prompt_cache(model), 0
+
+def _store_session_cache(session_id: str, ids: list[int], cache):
+    # The decode loop may have run one token ahead of (or behind) what was yielded.
+    offset = cache[0].offset
+    if offset > len(ids):
+        trim_prompt_cache(cache, offset - len(ids))
+    SESSION_CACHE[session_id] = (ids[:offset], cache)
+    while len(SESSION_CACHE) > MAX_CACHED_SESSIONS:
+        SESSION_CACHE.popitem(last=False)
+
+def _run_generation(loop, job: Job):
+    """Blocking decode loop; pushes token text (or an exception) then a None sentinel."""
+    def push(item):
+        loop.call_soon_threadsafe(job.resp_q.put_nowait, item)
+
+    prompt, kwargs = job.prompt, {}
+    if KV_BITS is not None:
+        kwargs["kv_bits"] = KV_BITS
+        kwargs["quantized_kv_start"] = KV_QUANT_START
+    use_cache = False
+    try:
+        if job.session_id is not None and isinstance(prompt, list) and len(prompt) > 0:
+            cache, reused = _session_cache(job.session_id, prompt)
+            ids = list(prompt)
+            prompt = prompt[reused:]
+            kwargs["prompt_cache"] = cache
+            use_cache = True
+        for tok in stream_generate(model, tokenizer, prompt, max_tokens=job.max_tokens, **kwargs):
+            if use_cache:
+                ids.append(tok.token)
+            if job.cancel.is_set():
+                break
+            push(tok.text)
+    except Exception as e:
+        use_cache = False  # cache state is unknown after a failure
+        print(f"⚠️ Generation failed: {e}")
+        push(e)
+    finally:
+        if use_cache:
+            _store_session_cache(job.session_id, ids, cache)
+        push(None)
+
+class ContinuousBatcher:
+    """Blocking batched decode that admits newly queued jobs between decode steps,
+    so a request arriving mid-generation joins the running batch instead of waiting
+    for it to drain. Each token's text is streamed to its own Job."""
+
+    def __init__(self, loop, q: asyncio.Queue):
+        self.loop = loop
+        self.q = q
+        self.deferred: list[Job] = []  # session jobs pulled mid-batch; decoded between steps
+
+    def push(self, job: Job, item):
+        self.loop.call_soon_threadsafe(job.resp_q.put_nowait, item)
+
+    async def _drain(self, n: int) -> list[Job]:
+        jobs = []
+        while len(jobs) < n and not self.q.empty():
+            jobs.append(self.q.get_nowait())
+        return jobs
+
+    def _take_queued(self, n: int) -> list[Job]:
+        # Cheap unsynchronized peek first, so an empty queue costs no event-loop round
+        # trip per decode step; a job it misses is picked up on the next step.
+        if self.q.empty():
+            return []
+        # asyncio.Queue is not thread-safe: drain it on the event loop.
+        jobs = asyncio.run_coroutine_threadsafe(self._drain(n), self.loop).result()
+        jobs = [job for job in jobs if not job.cancel.is_set()]
+        self.deferred += [job for job in jobs if job.session_id is not None]
+        return [job for job in jobs if job.session_id is None]
+
+    def _run_deferred(self):
+        """Decode waiting session jobs now, pausing the batch, instead of after it drains."""
+        jobs, self.deferred = self.deferred, []
+        for job in jobs:
+            try:
+                _run_generation(self.loop, job)
+            except Exception as e:
+                print(f"⚠️ Worker error: {e}")
+                self.push(job, e)
+                self.push(job, None)
+
+    def _admit(self, gen, active: dict, jobs: list[Job]):
+        if not jobs:
+            return
+        uids = gen.insert([job.prompt for job in jobs], [job.max_tokens for job in jobs])
+        admitted = {}
+        for uid, job in zip(uids, jobs):
+            detok = copy.copy(tokenizer.detokenizer)  # per-request streaming state
+            detok.reset()
+            admitted[uid] = (job, detok)
+        active.update(admitted)  # all or nothing, so a failure leaves each job in one place
+
+    def run(self, jobs: list[Job]):
+        active: dict = {}       # uid -> (job, detokenizer)
+        admitting = list(jobs)  # handed to _admit but not yet in active
+        gen = None
+        try:
+            gen = BatchGenerator(
+                model,
+                stop_tokens=[[t] for t in tokenizer.eos_token_ids],  # stop *sequences*
+                completion_batch_size=MAX_BATCH_SIZE,
+            )
+            self._admit(gen, active, admitting)
+            admitting = []
+            while active:
+                # next() also reports prefill progress; only generated tokens matter here.
+                responses = gen.next_generated()
+                if not responses:
+                    break  # nothing left in the generator; finally ends the stragglers
+                for r in responses:
+                    job, detok = active[r.uid]
+                    if r.finish_reason != "stop":
+                        detok.add_token(r.token)
+                    if r.finish_reason is not None:
+                        detok.finalize()
+                    seg = detok.last_segment  # reading it advances the detokenizer
+                    if seg:
+                        self.push(job, seg)
+                    if r.finish_reason is not None:
+                        del active[r.uid]
+                        self.push(job, None)
+                cancelled = [uid for uid, (job, _) in active.items() if job.cancel.is_set()]
+                if cancelled:
+                    gen.remove(cancelled)
+                    for uid in cancelled:
+                        self.push(active.pop(uid)[0], None)
+                if len(active) < MAX_BATCH_SIZE:
+                    admitting = self._take_queued(MAX_BATCH_SIZE - len(active))
+                    self._admit(gen, active, admitting)
+                    admitting = []
+                # Session jobs pulled above get the model before the next batch step.
+                self._run_deferred()
+        except Exception as e:
+            print(f"⚠️ Batched generation failed: {e}")
+            for job in [job for job, _ in active.values()] + admitting:
+                self.push(job, e)
+        finally:
+            for job in [job for job, _ in active.values()] + admitting:
+                self.push(job, None)
+            if gen is not None:
+                gen.close()  # restores the wired-memory limit the generator raised
+            self._run_deferred()  # session jobs pulled before a failure still run
+
+async def _collect_batch(q: asyncio.Queue) -> list[Job]:
+    """Wait for one job, then gather more for up to MAX_BATCH_DELAY seconds."""
+    jobs = [await q.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MAX_BATCH_DELAY
+    # Session jobs are decoded alone, so once one is in hand waiting only delays it.
+    while len(jobs) < MAX_BATCH_SIZE and jobs[-1].session_id is None:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            jobs.append(await asyncio.wait_for(q.get(), timeout=remaining))
+        except asyncio.TimeoutError:
+            break
+    return [job for job in jobs if not job.cancel.is_set()]
+
+def _warm_up():
+    """Page in the weights, then run tiny generations so Metal kernels are compiled
+    before the first user request instead of during its TTFT. Best effort: on failure
+    the server still starts and weights page in on the first request."""
+    try:
+        mx.eval(model.parameters())
+        generate(model, tokenizer, prompt="hi", max_tokens=4, verbose=False)
+        generate(model, tokenizer, prompt="x" * 1024, max_tokens=1, verbose=False)  # larger prefill matmuls
+    except Exception as e:
+        print(f"⚠️ Warmup failed, continuing without it: {e}")
 
-@app.post("/chat")
-async def chat(req: ChatRequest):
+async def server_loop(q: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    # Queued requests simply wait here until the weights are resident.
+    await loop.run_in_executor(None, _warm_up)
+    app.model_ready.set()
+    print("✅ Model loaded and ready.")
+    batcher = ContinuousBatcher(loop, q)
+    while True:
+        jobs = await _collect_batch(q)
+        batchable = []
+        if BatchGenerator is not None:
+            # Session jobs keep their own KV cache, so they are decoded individually,
+            # ahead of the batch so an interactive turn never waits for it to drain.
+            batchable = [job for job in jobs if job.session_id is None]
+            jobs = [job for job in jobs if job.session_id is not None]
+        # Session jobs (or no batch support) stream token by token.
+        for job in jobs:
+            try:
+                await loop.run_in_executor(None, _run_generation, loop, job)
+            except Exception as e:
+                # One bad job must not take the worker (and every later request) down.
+                print(f"⚠️ Worker error: {e}")
+                job.resp_q.put_nowait(e)
+                job.resp_q.put_nowait(None)
+        if batchable:
+            try:
+                await loop.run_in_executor(None, batcher.run, batchable)
+            except Exception as e:  # run() fails its own jobs; just keep serving
+                print(f"⚠️ Batch worker error: {e}")
+
+async def submit(prompt, max_tokens: int, session_id: Optional[str] = None):
+    """Enqueue a job for server_loop; yields token text until generation ends."""
+    job = Job(prompt, max_tokens, session_id)
+    async with app.request_slots:
+        await app.model_queue.put(job)
+        try:
+            while True:
+                item = await job.resp_q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Client went away (or we finished): let server_loop skip/stop this job.
+            job.cancel.set()
+
+def _sse(payload: bytes) -> bytes:
+    return b"data: " + payload + b"\n\n"
+
+async def event_stream(prompt, max_tokens: int, session_id: Optional[str] = None):
+    """Relay tokens from the model worker as SSE events."""
+    try:
+        async for text in submit(prompt, max_tokens, session_id):
+            yield _sse(msgspec.json.encode({"choices": [{"delta": {"content": text}}]}))
+    except Exception as e:
+        yield _sse(msgspec.json.encode({"error": str(e)}))
+    yield _sse(b"[DONE]")
+
+def _messages_key(messages: list[dict]) -> tuple:
+    return tuple(
+        (m.get("role"), hashlib.blake2b(str(m.get("content", "")).encode(), digest_size=8).digest())
+        for m in messages
+    )
+
+def _build_prompt(messages: list[dict]):
+    if tokenizer.chat_template is None:
+        return messages
+    # The whole list is the key: Qwen3's template renders earlier assistant turns
+    # differently depending on later ones, so a cached prefix can't be concatenated.
+    key = _messages_key(messages)
+    with PROMPT_CACHE_LOCK:
+        ids = PROMPT_CACHE.get(key)
+        if ids is not None:
+            PROMPT_CACHE.move_to_end(key)
+            return ids
+    ids = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=True)
+    with PROMPT_CACHE_LOCK:
+        PROMPT_CACHE[key] = ids
+        while len(PROMPT_CACHE) > MAX_CACHED_PROMPTS:
+            PROMPT_CACHE.popitem(last=False)
+    return ids
+
+_TRUE_STRINGS = {"true", "1", "yes", "on"}
+_FALSE_STRINGS = {"false", "0", "no", "off", ""}
+
+def _parse_stream_flag(value) -> bool:
+    """Accept real booleans plus the int/string spellings old clients send."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return bool(value)
+    if isinstance(value, str):
+        flag = value.strip().lower()
+        if flag in _TRUE_STRINGS:
+            return True
+        if flag in _FALSE_STRINGS:
+            return False
+    if value is None:
+        return False
+    raise HTTPException(status_code=422, detail=f"Invalid value for `stream`: {value!r}")
+
+def _parse_chat_request(raw: bytes) -> ChatRequest:
+    """Decode + validate straight from the body bytes in one msgspec pass."""
+    try:
+        req = msgspec.json.decode(raw, type=ChatRequest)
+    except msgspec.ValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except msgspec.DecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body.")
+    req.stream = _parse_stream_flag(req.stream)
+    req.session_id = str(req.session_id) if req.session_id else None
+    return req
+
+@app.post("/chat", response_model=None)
+async def chat(request: Request):
     if model is None or tokenizer is None:
         raise HTTPException(status_code=500, detail="Model not loaded yet.")
+    req = _parse_chat_request(await request.body())
 
     try:
-        prompt = req.messages
-        if tokenizer.chat_template is not None:
-            prompt = tokenizer.apply_chat_template(
-                req.messages, add_generation_prompt=True
-            )
+        # Templating + tokenizing a long history is pure Python; keep it off the event loop.
+        prompt = await asyncio.get_running_loop().run_in_executor(None, _build_prompt, req.messages)
 
-        output = generate(
-            model,
-            tokenizer,
-            prompt=prompt,
-            verbose=False,
-            max_tokens=req.max_new_tokens
-        )
+        if req.stream:
+            return StreamingResponse(
+                event_stream(prompt, req.max_new_tokens, req.session_id),
+                media_type="text/event-stream",
+                headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+            )
 
-        return {"response": output}
+        output = "".join([text async for text in submit(prompt, req.max_new_tokens, req.session_id)])
+        return Response(msgspec.json.encode({"response": output}), media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/")
+@app.get("/", response_model=None)
 async def root():
+    if not app.model_ready.is_set():
+        return JSONResponse(status_code=503, content={"message": "Model is warming up."})
     return {"message": "Qwen MLX Chat API is running. Use POST /chat to interact."}
@@ -2,20 +2,79 @@ const chatHistory = document.getElementById("chat-history");
 const userInput = document.getElementById("user-input");
 const sendBtn = document.getElementById("send-btn");
 
+const history = [];
+
 async function sendMessage() {
   const text = userInput.value.trim();
-  if (!text) return;
+  if (!text || sendBtn.disabled) return;
 
   addMessage(text, "user");
   userInput.value = "";
+  history.push({role: "user", content: text});
+  // One request at a time, so replies can't interleave in history.
+  sendBtn.disabled = true;
+  try {
+    const reply = await streamReply();
+    history.push({role: "assistant", content: reply});
+  } catch (err) {
+    history.pop();  // keep user/assistant turns paired; don't replay a failed turn
+    addMessage(`[error] ${err.message}`, "bot");
+  } finally {
+    sendBtn.disabled = false;
+  }
+}
 
+// Streams the reply for `history` into a new bot bubble; throws on any failure.
+async function streamReply() {
   const res = await fetch("http://127.0.0.1:8000/chat", {
     method: "POST",
     headers: {"Content-Type": "application/json"},
-    body: JSON.stringify({prompt: text})
+    body: JSON.stringify({messages: history, stream: true})
   });
-  const data = await res.json();
-  addMessage(data.response, "bot");
+  if (!res.ok) {
+    // e.g. 500 before the model is loaded, 422 on a bad request: the body is JSON, not SSE.
+    throw new Error(`${res.status} ${await res.text()}`);
+  }
+
+  // Append SSE deltas as they arrive instead of waiting for the whole reply.
+  const bot = addMessage("", "bot");
+  const parts = [];
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buf = "";
+  let done = false;
+  while (!done) {
+    const {value, done: eof} = await reader.read();
+    if (eof) break;
+    buf += decoder.decode(value, {stream: true});
+    const events = buf.split("\n\n");
+    buf = events.pop();
+    for (const event of events) {
+      if (!event.startsWith("data:")) continue;
+      const data = event.slice(5).trim();
+      if (data === "[DONE]") { done = true; break; }
+      let obj;
+      try {
+        obj = JSON.parse(data);
+      } catch (e) {
+        continue;  // skip a malformed event instead of aborting the reply
+      }
+      if (!obj || typeof obj !== "object") continue;
+      if (obj.error) {
+        bot.remove();
+        throw new Error(obj.error);
+      }
+      if (obj.choices && obj.choices[0] && obj.choices[0].delta) parts.push(obj.choices[0].delta.content || "");
+    }
+    bot.textContent = parts.join("");
+    chatHistory.scrollTop = chatHistory.scrollHeight;
+  }
+  const reply = parts.join("");
+  if (!reply) {
+    bot.remove();
+    throw new Error("no response");
+  }
+  return reply;
 }
 
 function addMessage(text, role) {
@@ -24,6 +83,7 @@ function addMessage(text, role) {
   msg.innerText = text;
   chatHistory.appendChild(msg);
   chatHistory.scrollTop = chatHistory.scrollHeight;
+  return msg;
 }
 
 sendBtn.addEventListener("click", sendMessage);
@@ -1,10 +1,16 @@
 # streamlit_app.py
 import streamlit as st
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import orjson
 import re
+import html
 import markdown
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from typing import Optional, Tuple
 
 # ---------------- CONFIG (tweak these) ----------------
@@ -74,9 +80,9 @@ textarea { width:100%; min-height:90px; padding:12px; border-radius:10px; border
 st.markdown(CSS, unsafe_allow_html=True)
 
 # ---------------- session initialization ----------------
-if "messages" not in st.session_state:
-    st.session_state.messages = [
-        {"role":"system", "content": (
+# the system prompt lives outside `messages`; it is prepended only when a payload is sent
+if "system_message" not in st.session_state:
+    st.session_state.system_message = {"role":"system", "content": (
 """You are a reasoning assistant. When possible, emit labeled sections: 'Thought:', 'Reasoning:', and 'Final Answer:'. The client will present 'Thinking' (Thought + Reasoning) separately from the Final Answer. 
 
 @Strictly ensure sentences are complete—never stop mid-word, mid-sentence, or mid-thought without closure. 
@@ -88,84 +94,257 @@ Here are some example user prompts to guide reasoning style:
 - Extract key facts, reason clearly, then provide a brief final answer.
 - Reason logically and avoid tangents; summarize with confidence.
 - Break down the question smartly and come to the point fast.
-- Use precise reasoning to reach a direct, well-supported conclusion.""") }    ]
+- Use precise reasoning to reach a direct, well-supported conclusion.""") }
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+
+# lets the backend reuse this conversation's KV cache across turns
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # ---------------- parsing utilities ----------------
+_LEADING_JUNK_RE = re.compile(r'^[\s\'"`,\.-]+')
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# ASCII-only lowercasing keeps indices aligned with the original text
+# (str.lower can change the length of some non-ASCII strings).
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def _find_any(lo: str, labels: Tuple[str, ...], start: int = 0) -> int:
+    """Earliest index of any label in lo at or after start, or len(lo)."""
+    end = len(lo)
+    for label in labels:
+        i = lo.find(label, start, end)
+        if i != -1:
+            end = i
+    return end
+
+_FINAL_LABELS = ("final answer:", "inal answer:")   # also catch a truncated "F"
+
+@lru_cache(maxsize=512)  # history replay re-parses the same past messages every rerun
 def parse_thinking_and_final(text: str) -> Tuple[Optional[str], Optional[str]]:
     """Return (thinking_text, final_text). Thinking merges Thought + Reasoning."""
     if not text:
         return None, None
     s = text.strip()
-    s = re.sub(r'^[\s\'"`,\.-]+', '', s)
-
-    thought_pat = re.compile(r"Thought:\s*(.*?)(?=(?:Reasoning:|Final Answer:|inal Answer:|$))", re.I | re.S)
-    reasoning_pat = re.compile(r"Reasoning:\s*(.*?)(?=(?:Final Answer:|inal Answer:|$))", re.I | re.S)
-    final_pat = re.compile(r"(?:Final Answer:|inal Answer:)\s*(.*)$", re.I | re.S)
+    s = _LEADING_JUNK_RE.sub('', s)
 
-    thought_m = thought_pat.search(s)
-    reasoning_m = reasoning_pat.search(s)
-    final_m = final_pat.search(s)
+    # one lowercase copy, then str.find for each label: no regex backtracking
+    lo = s.translate(_ASCII_LOWER)
+    n = len(s)
+    i_t = lo.find("thought:")
+    i_r = lo.find("reasoning:")
+    i_f = _find_any(lo, _FINAL_LABELS)
+    has_final = i_f < n
 
     parts = []
-    if thought_m:
-        t = thought_m.group(1).strip()
+    if i_t != -1:
+        start = i_t + len("thought:")
+        t = s[start:_find_any(lo, ("reasoning:",) + _FINAL_LABELS, start)].strip()
         if t:
             parts.append(t)
-    if reasoning_m:
-        r = reasoning_m.group(1).strip()
+    if i_r != -1:
+        start = i_r + len("reasoning:")
+        r = s[start:_find_any(lo, _FINAL_LABELS, start)].strip()
         if r:
             parts.append(r)
 
-    if final_m and not (thought_m or reasoning_m):
-        pre = s[:final_m.start()].strip()
+    if has_final and i_t == -1 and i_r == -1:
+        pre = s[:i_f].strip()
         if pre:
             parts = [pre]
 
-    if not (thought_m or reasoning_m or final_m):
+    if i_t == -1 and i_r == -1 and not has_final:
         parts = [s] if s else []
 
     thinking = "\n\n".join(parts).strip() if parts else None
-    final_text = final_m.group(1).strip() if final_m else None
+    final_text = None
+    if has_final:
+        label = "final answer:" if lo.startswith("final answer:", i_f) else "inal answer:"
+        final_text = s[i_f + len(label):].strip()
     return thinking, final_text
 
-def is_buffer_truncated(buffer: str) -> bool:
-    """Heuristic: returns True if buffer ends mid-word or without terminal punctuation."""
-    if not buffer:
-        return False
-    b = buffer.rstrip()
-    last_char = b[-1]
-    if last_char.isalnum():
-        # check for terminal punctuation in last 3 chars
-        if not re.search(r'[.!?]\s*$', b[-3:]):
-            return True
-    return False
+_MARKER_RES = {
+    "PRE": re.compile(r"Thought:|Reasoning:|Final Answer:|inal Answer:", re.I),
+    "THOUGHT": re.compile(r"Reasoning:|Final Answer:|inal Answer:", re.I),
+    "REASONING": re.compile(r"Final Answer:|inal Answer:", re.I),
+}
+_MARKER_MAX_LEN = len("Final Answer:")
+
+class StreamParser:
+    """Incremental counterpart of parse_thinking_and_final for streamed text.
+
+    Each feed() only searches the new piece (plus a marker-sized overlap) for
+    the next section marker and appends the piece to a list, so a stream of N
+    chunks costs O(N). The full text is joined only when result()/buf is read.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._len = 0
+        self._carry = ""   # unscanned-for-markers tail of the previous pieces
+        self.dirty = False
+        self.stage = "PRE"
+        # (marker_start, content_start) per section, or None if not seen yet
+        self.thought = None
+        self.reasoning = None
+        self.final = None
+
+    @property
+    def buf(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, piece: str) -> None:
+        window = self._carry + piece
+        base = self._len - len(self._carry)
+        self._parts.append(piece)
+        self._len += len(piece)
+        self.dirty = True
+        pos = 0
+        while self.stage != "FINAL":
+            m = _MARKER_RES[self.stage].search(window, pos)
+            if not m:
+                break
+            label = m.group(0).lower()
+            span = (base + m.start(), base + m.end())
+            if label == "thought:":
+                self.thought, self.stage = span, "THOUGHT"
+            elif label == "reasoning:":
+                self.reasoning, self.stage = span, "REASONING"
+            else:
+                self.final, self.stage = span, "FINAL"
+            pos = m.end()
+        # keep a marker-sized overlap so labels split across chunks are found
+        self._carry = window[max(pos, len(window) - _MARKER_MAX_LEN + 1):]
+
+    def _section(self, buf: str, span, end_span) -> str:
+        end = end_span[0] if end_span else len(buf)
+        return buf[span[1]:end].strip()
+
+    def result(self) -> Tuple[Optional[str], Optional[str]]:
+        buf = self.buf
+        self.dirty = False
+        parts = []
+        if self.thought:
+            t = self._section(buf, self.thought, self.reasoning or self.final)
+            if t:
+                parts.append(t)
+        if self.reasoning:
+            r = self._section(buf, self.reasoning, self.final)
+            if r:
+                parts.append(r)
+        if self.final and not (self.thought or self.reasoning):
+            pre = _LEADING_JUNK_RE.sub('', buf[:self.final[0]].strip()).strip()
+            if pre:
+                parts = [pre]
+        if not (self.thought or self.reasoning or self.final):
+            s = _LEADING_JUNK_RE.sub('', buf.strip())
+            parts = [s] if s else []
+
+        thinking = "\n\n".join(parts).strip() if parts else None
+        final_text = buf[self.final[1]:].strip() if self.final else None
+        return thinking, final_text
 
 # ---------------- API helpers ----------------
+# One keep-alive connection pool for stream, finish-retry and summarizer calls.
+_SESSION = requests.Session()
+_SESSION.headers["Accept-Encoding"] = "identity"   # no compression on streamed bodies
+# finish + summarizer run concurrently; keep their sockets pooled too
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 def post_request(payload: dict, stream: bool = False, timeout: int = 30):
-    """Wrapper for requests.post; returns response object if stream True, or JSON/dict if non-streaming."""
+    """Wrapper for _SESSION.post; returns response object if stream True, or JSON/dict if non-streaming."""
+    body = orjson.dumps(payload)  # not requests' stdlib json.dumps
+    headers = {"Content-Type": "application/json"}
     if stream:
-        return requests.post(API_URL, json=payload, stream=True, timeout=STREAM_TIMEOUT)
+        return _SESSION.post(API_URL, data=body, headers=headers, stream=True, timeout=STREAM_TIMEOUT)
     else:
-        resp = requests.post(API_URL, json=payload, timeout=timeout)
+        resp = _SESSION.post(API_URL, data=body, headers=headers, timeout=timeout)
         try:
-            return resp.json()
+            return orjson.loads(resp.content)
         except Exception:
             return {"response": resp.text}
 
-def request_finish_from_model(buffer: str, max_new_tokens: int) -> Optional[str]:
+_SSE_META_PREFIXES = (":", "event:", "id:", "retry:")
+
+def iter_sse_events(resp, chunk_size: int = 4096):
+    """Yield (raw_line, data) pairs from a streaming response, one per line.
+
+    Lines are split on single newlines so output stays incremental whether or
+    not the backend separates events with blank lines: a `data:` line yields
+    its payload, SSE comments/fields are skipped, and any other non-empty line
+    (bare NDJSON/text backends) is yielded as-is.
+    """
+    buf = bytearray()
+
+    def parse(line: str):
+        line = line.rstrip("\r")
+        if line.startswith("data:"):
+            yield line, line[5:].strip()
+        elif line.strip() and not line.startswith(_SSE_META_PREFIXES):
+            yield line, line.strip()
+
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        if not chunk:
+            continue
+        buf += chunk
+        start = 0
+        # one del per network read instead of shifting the buffer once per line
+        while (i := buf.find(b"\n", start)) != -1:
+            line = buf[start:i].decode("utf-8", "replace")
+            start = i + 1
+            yield from parse(line)
+        del buf[:start]
+    if buf:
+        yield from parse(bytes(buf).decode("utf-8", "replace"))
+
+def stream_collect(payload: dict, cancel: threading.Event) -> Optional[str]:
+    """Streamed POST joined into one string, or None on cancel/empty output.
+    HTTP and backend errors raise RuntimeError so a broken backend path stays visible.
+
+    Streaming (rather than a blocking call) means a cancelled caller closes the
+    connection, and the backend stops generating for it.
+    """
+    parts = []
+    with post_request({**payload, "stream": True}, stream=True) as resp:
+        if resp.status_code != 200:
+            raise RuntimeError(f"Error {resp.status_code}: {resp.text}")
+        for _, data in iter_sse_events(resp):
+            if cancel.is_set():
+                return None
+            if data == "[DONE]":
+                break
+            try:
+                obj = orjson.loads(data)
+            except Exception:
+                parts.append(data)
+                continue
+            if not isinstance(obj, dict):
+                return None
+            if obj.get("error"):
+                raise RuntimeError(f"backend error: {obj['error']}")
+            choices = obj.get("choices")
+            if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+                delta = choices[0].get("delta") or {}
+                parts.append(delta.get("content") or "")
+    text = "".join(parts).strip()
+    return text or None
+
+def request_finish_from_model(buffer: str, max_new_tokens: int, history: list, cancel: threading.Event) -> Optional[str]:
     """
-    Ask the model to finish the assistant output. Return text or None on failure.
+    Ask the model to finish the assistant output. Return text, or None on cancel/empty output;
+    request and backend failures raise.
     We send system + last user + assistant partial + user instruction to finish.
+    `history` is passed in (not read from st.session_state) so this can run in a worker thread;
+    setting `cancel` abandons the call and frees its backend job.
     """
-    messages = []
-    # include system if present
-    for m in st.session_state.messages:
-        if m["role"] == "system":
-            messages.append(m)
-            break
+    # include system if present (callers put it first, so no scan over the history)
+    messages = history[:1] if history and history[0]["role"] == "system" else []
     # include last user
     last_user = None
-    for m in reversed(st.session_state.messages):
+    for m in reversed(history):
         if m["role"] == "user":
             last_user = m
             break
@@ -182,265 +361,310 @@ def request_finish_from_model(buffer: str, max_new_tokens: int) -> Optional[str]
         )
     })
     payload = {"messages": messages, "max_new_tokens": max_new_tokens}
-    try:
-        j = post_request(payload, stream=False, timeout=30)
-        if isinstance(j, dict):
-            candidate = j.get("response") or j.get("text") or ""
-            if not candidate and "choices" in j and isinstance(j["choices"], list) and j["choices"]:
-                c0 = j["choices"][0]
-                candidate = c0.get("text") or (c0.get("message") or {}).get("content") or ""
-            if candidate and isinstance(candidate, str):
-                return candidate.strip()
-        # otherwise if server returned stringish content
-    except Exception:
-        pass
-    return None
-
-def request_summarize_with_model(thinking_text: str, max_new_tokens: int) -> Optional[str]:
-    """Ask the model (non-streaming) to synthesize Thinking into a concise final answer."""
+    return stream_collect(payload, cancel)
+
+def request_summarize_with_model(thinking_text: str, max_new_tokens: int, cancel: threading.Event) -> Optional[str]:
+    """Ask the model to synthesize Thinking into a concise final answer (cancellable via `cancel`; failures raise)."""
     if not thinking_text:
         return None
     system_msg = {"role":"system", "content":"You are a concise assistant. Given Thinking text, output a single concise Final Answer paragraph and no chain-of-thought."}
     user_msg = {"role":"user", "content": f"Thinking text:\n\n{thinking_text}\n\nProduce a concise Final Answer (one short paragraph)."}
     payload = {"messages":[system_msg, user_msg], "max_new_tokens": max_new_tokens}
-    try:
-        j = post_request(payload, stream=False, timeout=30)
-        if isinstance(j, dict):
-            candidate = j.get("response") or j.get("text") or ""
-            if not candidate and "choices" in j and isinstance(j["choices"], list) and j["choices"]:
-                c0 = j["choices"][0]
-                candidate = c0.get("text") or (c0.get("message") or {}).get("content") or ""
-            if candidate and isinstance(candidate, str):
-                return candidate.strip()
-    except Exception:
-        pass
-    return None
+    return stream_collect(payload, cancel)
 
 # ---------------- rendering helpers ----------------
+def _plain_html(text: str) -> str:
+    """Cheap escaped rendering used mid-stream; full markdown runs once at the end."""
+    return html.escape(text).replace("\n", "<br>")
+
+_MD_EXTENSIONS = ("fenced_code", "codehilite")
+_MD_LOCAL = threading.local()   # Markdown instances are stateful; one set per script thread
+
+def _md_instance(extensions: tuple) -> markdown.Markdown:
+    """Reusable Markdown converter, so extensions are set up once rather than per call."""
+    instances = getattr(_MD_LOCAL, "instances", None)
+    if instances is None:
+        instances = _MD_LOCAL.instances = {}
+    md = instances.get(extensions)
+    if md is None:
+        md = instances[extensions] = markdown.Markdown(extensions=list(extensions))
+    return md
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def _render_md(text: str, extensions: tuple = _MD_EXTENSIONS) -> str:
+    """Markdown to HTML memoized on the text, so replayed history is rendered once."""
+    return _md_instance(extensions).reset().convert(text)
+
+@st.cache_data(show_spinner=False, max_entries=1024)
+def _render_assistant_html(content: str) -> str:
+    """Thinking + final cards for a past assistant message, built once per distinct content."""
+    thinking, final = parse_thinking_and_final(content)
+    out = ""
+    if thinking:
+        out += (
+            f'<div class="thinking-card"><div class="thinking-header">Thinking</div>'
+            f'<div class="thinking-body">{_render_md(thinking)}</div></div>'
+        )
+    if final:
+        out += f'<div class="final-card"><strong>Final Answer</strong><div style="margin-top:8px">{_render_md(final, ())}</div></div>'
+    return out
+
+def _message_html(m: dict) -> str:
+    if m["role"] == "user":
+        # user text is shown verbatim: escaping is enough, no markdown pass
+        return f'<div class="message user">{_plain_html(m["content"])}</div>'
+    return _render_assistant_html(m["content"])
+
+def render_message(m: dict):
+    message_html = _message_html(m)
+    if message_html:
+        st.markdown(message_html, unsafe_allow_html=True)
+
+_PRE_BLOCK_RE = re.compile(r"<pre\b.*?</pre>", re.S)
+_BLANK_LINE_RE = re.compile(r"\n[ \t]*(?=\n)")
+
+def _single_html_block(fragment: str) -> str:
+    """A blank line ends a CommonMark HTML block, so one code block with an empty line
+    would break every message after it in the joined history. Newlines inside <pre>
+    become &#10; (code keeps its layout); blank lines elsewhere are dropped."""
+    fragment = _PRE_BLOCK_RE.sub(lambda m: m.group(0).replace("\n", "&#10;"), fragment)
+    return _BLANK_LINE_RE.sub("", fragment)
+
 def render_history():
-    st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-    for m in st.session_state.messages:
-        if m["role"] == "system":
-            continue
-        if m["role"] == "user":
-            st.markdown(f'<div class="message user">{markdown.markdown(m["content"])}</div>', unsafe_allow_html=True)
-        else:
-            thinking, final = parse_thinking_and_final(m["content"])
-            if thinking:
-                thinking_html = (
-                    f'<div class="thinking-card"><div class="thinking-header">Thinking</div>'
-                    f'<div class="thinking-body">{markdown.markdown(thinking, extensions=["fenced_code","codehilite"])}</div></div>'
-                )
-                st.markdown(thinking_html, unsafe_allow_html=True)
-            if final:
-                final_html = f'<div class="final-card"><strong>Final Answer</strong><div style="margin-top:8px">{markdown.markdown(final)}</div></div>'
-                st.markdown(final_html, unsafe_allow_html=True)
-    st.markdown('</div>', unsafe_allow_html=True)
+    """Emit the whole history as one element; only messages appended since the last run are rendered."""
+    messages = st.session_state.messages
+    if "rendered_html" not in st.session_state:
+        st.session_state.rendered_html = []
+    rendered = st.session_state.rendered_html
+    if len(rendered) > len(messages):  # history was replaced
+        rendered.clear()
+    rendered.extend(_single_html_block(_message_html(m)) for m in messages[len(rendered):])
+    st.markdown(f'<div class="chat-container message-row">{"".join(rendered)}</div>', unsafe_allow_html=True)
+    # turns added after this point are drawn by the input fragment itself
+    st.session_state.history_rendered_upto = len(messages)
 
 # ---------------- Page render ----------------
 render_history()
 
 # ---------------- Input form ----------------
-with st.form("chat_form", clear_on_submit=True):
-    user_input = st.text_area("Your message:", height=90, key="input")
-    submitted = st.form_submit_button("Send")
-
-if submitted and user_input and user_input.strip():
-    st.session_state.messages.append({"role":"user", "content": user_input.strip()})
-
-    # placeholders created only inside handler
-    stream_ph = st.empty()
-    debug_ph = st.empty() if st.session_state.get("ui_stream_debug", False) else None
-
-    # initial thinking card with typing dots
-    init_html = ('<div class="thinking-card"><div class="thinking-header">Thinking '
-                 '<span class="typing-dots"><span></span><span></span><span></span></span></div>'
-                 '<div class="thinking-body"></div></div>')
-    stream_ph.markdown(init_html, unsafe_allow_html=True)
-
-    buffer = ""
-    last_thinking = None
-    last_final = None
-    last_update_time = 0.0
-    raw_lines = []
-    finish_attempts = 0
-    final_source = "stream"  # will be updated to 'finish (n)', 'summarizer', or 'heuristic'
-
-    payload = {"messages": st.session_state.messages, "max_new_tokens": MAX_NEW_TOKENS_STREAM, "stream": True}
-
-    try:
-        # start streaming request
-        with post_request(payload, stream=True) as resp:
-            if resp.status_code != 200:
-                # fallback non-streaming
-                try:
-                    j = resp.json()
-                    full_text = j.get("response") or j.get("text") or json.dumps(j)
-                except Exception:
-                    full_text = f"Error {resp.status_code}: {resp.text}"
-                st.session_state.messages.append({"role":"assistant", "content": full_text})
-                st.experimental_rerun()
-
-            for raw_line in resp.iter_lines(decode_unicode=True):
-                raw_lines.append(raw_line)
-                if raw_line is None:
-                    continue
-                line = raw_line.strip()
-                if not line:
-                    continue
-
-                if debug_ph:
-                    debug_text = "\n".join(raw_lines[-200:])
-                    debug_ph.code(debug_text, language="text")
-
-                # handle SSE 'data:' prefix (OpenAI-style)
-                if line.startswith("data:"):
-                    data = line[len("data:"):].strip()
-                else:
-                    data = line
-
-                if data == "[DONE]":
-                    break
-
-                piece = ""
-                try:
-                    obj = json.loads(data)
-                    choices = obj.get("choices")
-                    if isinstance(choices, list) and choices:
-                        c0 = choices[0]
-                        delta = c0.get("delta") if isinstance(c0, dict) else {}
-                        if isinstance(delta, dict):
-                            piece = delta.get("content") or ""
+@st.fragment
+def chat_input_fragment():
+    """Input form + streaming handler. Submitting reruns only this fragment, not render_history()."""
+    # new turns are drawn into this container, above the form, so the input stays at the bottom
+    turns = st.container()
+    # turns sent since the last full-page run
+    with turns:
+        for m in st.session_state.messages[st.session_state.get("history_rendered_upto", 0):]:
+            render_message(m)
+
+    with st.form("chat_form", clear_on_submit=True):
+        user_input = st.text_area("Your message:", height=90, key="input")
+        submitted = st.form_submit_button("Send")
+
+    if submitted and user_input and user_input.strip():
+        user_msg = {"role":"user", "content": user_input.strip()}
+        st.session_state.messages.append(user_msg)
+        with turns:
+            # the replay loop above already ran; draw this turn's bubble now
+            render_message(user_msg)
+
+            # placeholders created only inside handler
+            stream_ph = st.empty()
+            debug_ph = st.empty() if st.session_state.get("ui_stream_debug", False) else None
+
+        # initial thinking card with typing dots
+        init_html = ('<div class="thinking-card"><div class="thinking-header">Thinking '
+                     '<span class="typing-dots"><span></span><span></span><span></span></span></div>'
+                     '<div class="thinking-body"></div></div>')
+        stream_ph.markdown(init_html, unsafe_allow_html=True)
+
+        parser = StreamParser()
+        last_thinking = None
+        last_final = None
+        last_update_time = time.monotonic()
+        last_debug_time = 0.0
+        raw_lines = []
+        finish_attempts = 0
+        final_source = "stream"  # will be updated to 'finish (n)', 'summarizer', or 'heuristic'
+
+        payload = {"messages": [st.session_state.system_message, *st.session_state.messages], "max_new_tokens": MAX_NEW_TOKENS_STREAM, "stream": True,
+                   "session_id": st.session_state.session_id}
+
+        try:
+            # start streaming request
+            with post_request(payload, stream=True) as resp:
+                if resp.status_code != 200:
+                    # fallback non-streaming
+                    try:
+                        j = orjson.loads(resp.content)
+                        full_text = j.get("response") or j.get("text") or orjson.dumps(j).decode()
+                    except Exception:
+                        full_text = f"Error {resp.status_code}: {resp.text}"
+                    st.session_state.messages.append({"role":"assistant", "content": full_text})
+                    stream_ph.markdown(_plain_html(full_text), unsafe_allow_html=True)
+                    return
+
+                for raw_event, data in iter_sse_events(resp):
+                    raw_lines.append(raw_event)
+
+                    if debug_ph:
+                        now = time.monotonic()
+                        if now - last_debug_time >= UPDATE_THROTTLE_SEC:
+                            debug_ph.code("\n".join(raw_lines[-200:]), language="text")
+                            last_debug_time = now
+
+                    if data == "[DONE]":
+                        break
+
+                    piece = ""
+                    try:
+                        obj = orjson.loads(data)
+                        if isinstance(obj, dict) and obj.get("error"):
+                            # a failed generation arrives as {"error": ...} on the 200 stream
+                            full_text = f"Error: {obj['error']}"
+                            st.session_state.messages.append({"role":"assistant", "content": full_text})
+                            stream_ph.markdown(_plain_html(full_text), unsafe_allow_html=True)
+                            return
+                        choices = obj.get("choices")
+                        if isinstance(choices, list) and choices:
+                            c0 = choices[0]
+                            delta = c0.get("delta") if isinstance(c0, dict) else {}
+                            if isinstance(delta, dict):
+                                piece = delta.get("content") or ""
+                            if not piece:
+                                piece = c0.get("text") or (c0.get("message") or {}).get("content") or ""
                         if not piece:
-                            piece = c0.get("text") or (c0.get("message") or {}).get("content") or ""
+                            for k in ("response","content","text","data"):
+                                if k in obj and obj[k]:
+                                    v = obj[k]
+                                    piece = v.get("content") if isinstance(v, dict) else str(v)
+                                    break
+                    except Exception:
+                        piece = data
+
                     if not piece:
-                        for k in ("response","content","text","data"):
-                            if k in obj and obj[k]:
-                                v = obj[k]
-                                piece = v.get("content") if isinstance(v, dict) else str(v)
-                                break
-                except Exception:
-                    piece = data
-
-                if not piece:
-                    continue
-
-                buffer += piece
-
-                thinking_text, final_text = parse_thinking_and_final(buffer)
-
-                now = time.time()
-                if (thinking_text != last_thinking) or (final_text != last_final):
-                    if now - last_update_time >= UPDATE_THROTTLE_SEC:
-                        # build thinking card (typing dots when final missing)
-                        thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking'
-                        if not final_text:
-                            thinking_html += ' <span class="typing-dots"><span></span><span></span><span></span></span>'
-                        thinking_html += '</div>'
-                        thinking_html += f'<div class="thinking-body">{markdown.markdown(thinking_text or "", extensions=["fenced_code","codehilite"])}</div></div>'
-
-                        # build final card with badge if present
-                        if final_text:
-                            badge = f'<span class="badge">source: stream</span>'
-                            final_html = f'<div class="final-card"><div><strong>Final Answer</strong>{badge}</div><div style="margin-top:8px">{markdown.markdown(final_text, extensions=["fenced_code","codehilite"])}</div></div>'
-                            html = thinking_html + final_html
-                        else:
-                            html = thinking_html
-
-                        stream_ph.markdown(html, unsafe_allow_html=True)
-                        last_thinking = thinking_text
-                        last_final = final_text
-                        last_update_time = now
-
-                time.sleep(0.005)
-
-        # streaming finished
-        thinking_buffered = last_thinking or (buffer.strip() if buffer else None)
-        final_buffered = last_final
-
-        # 1) If no final and buffer looks truncated and auto_retry enabled -> try finish attempts
-        if not final_buffered and st.session_state.get("ui_auto_retry", True) and buffer:
-            max_retries = st.session_state.get("ui_max_finish_retries", MAX_FINISH_RETRIES_DEFAULT)
-            tokens_initial = st.session_state.get("ui_finish_tokens_initial", FINISH_TOKENS_INITIAL)
-            tokens_increment = st.session_state.get("ui_finish_tokens_increment", FINISH_TOKENS_INCREMENT)
-
-            # do finish attempts only if buffer likely truncated or there's no final label
-            if is_buffer_truncated(buffer) or not final_buffered:
-                attempt = 0
-                current_tokens = tokens_initial
-                while attempt < max_retries:
-                    attempt += 1
-                    finish_attempts += 1
-                    finished = request_finish_from_model(buffer, max_new_tokens=current_tokens)
-                    # update badge and counter UI to show attempt in progress
-                    badge_html = f'<span class="badge">source: finish (attempt {attempt})</span><span class="counter">tries: {attempt}</span>'
-                    # show intermediate update (thinking + badge)
-                    thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking'
-                    thinking_html += '</div>'
-                    thinking_html += f'<div class="thinking-body">{markdown.markdown(thinking_buffered or "", extensions=["fenced_code","codehilite"])}</div></div>'
+                        continue
+
+                    parser.feed(piece)
+
+                    now = time.monotonic()
+                    if parser.dirty and now - last_update_time >= UPDATE_THROTTLE_SEC:
+                        thinking_text, final_text = parser.result()
+                        if (thinking_text != last_thinking) or (final_text != last_final):
+                            # build thinking card (typing dots when final missing)
+                            thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking'
+                            if not final_text:
+                                thinking_html += ' <span class="typing-dots"><span></span><span></span><span></span></span>'
+                            thinking_html += '</div>'
+                            thinking_html += f'<div class="thinking-body">{_plain_html(thinking_text or "")}</div></div>'
+
+                            # build final card with badge if present
+                            if final_text:
+                                badge = f'<span class="badge">source: stream</span>'
+                                final_html = f'<div class="final-card"><div><strong>Final Answer</strong>{badge}</div><div style="margin-top:8px">{_plain_html(final_text)}</div></div>'
+                                card_html = thinking_html + final_html
+                            else:
+                                card_html = thinking_html
+
+                            stream_ph.markdown(card_html, unsafe_allow_html=True)
+                            last_thinking = thinking_text
+                            last_final = final_text
+                            last_update_time = now
+
+            # streaming finished (use the parser's state: the last throttled flush may be stale)
+            if debug_ph:
+                debug_ph.code("\n".join(raw_lines[-200:]), language="text")
+            buffer = parser.buf
+            last_thinking, last_final = parser.result()
+            thinking_buffered = last_thinking or (buffer.strip() if buffer else None)
+            final_buffered = last_final
+
+            # 1) + 2) If no final: one finish call with the full retry budget, and (optionally)
+            # the summarizer fired concurrently; the first usable answer wins.
+            if not final_buffered:
+                max_retries = st.session_state.get("ui_max_finish_retries", MAX_FINISH_RETRIES_DEFAULT)
+                tokens_initial = st.session_state.get("ui_finish_tokens_initial", FINISH_TOKENS_INITIAL)
+                tokens_increment = st.session_state.get("ui_finish_tokens_increment", FINISH_TOKENS_INCREMENT)
+                want_finish = bool(st.session_state.get("ui_auto_retry", True) and buffer and max_retries > 0)
+                want_summary = bool(st.session_state.get("ui_model_summarize", True) and thinking_buffered)
+
+                if want_finish or want_summary:
+                    labels = []
+                    if want_finish:
+                        labels.append("finish")
+                    if want_summary:
+                        labels.append("summarizer")
+                    badge_html = f'<span class="badge">source: {" + ".join(labels)}</span>'
+                    thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking</div>'
+                    thinking_html += f'<div class="thinking-body">{_render_md(thinking_buffered or "")}</div></div>'
                     final_preview = f'<div class="final-card"><div><strong>Final Answer</strong>{badge_html}</div><div style="margin-top:8px">finishing...</div></div>'
                     stream_ph.markdown(thinking_html + final_preview, unsafe_allow_html=True)
 
-                    if finished:
-                        # parse finished for final label
-                        _, parsed_final = parse_thinking_and_final(finished)
-                        if parsed_final:
-                            final_buffered = parsed_final
-                        else:
+                    pool = ThreadPoolExecutor(max_workers=2)
+                    cancel = threading.Event()
+                    futures = {}
+                    if want_finish:
+                        # the largest budget the old sequential retries would have reached
+                        finish_budget = tokens_initial + tokens_increment * (max_retries - 1)
+                        history = [st.session_state.system_message, *st.session_state.messages]
+                        futures[pool.submit(request_finish_from_model, buffer, finish_budget, history, cancel)] = "finish"
+                        finish_attempts += 1
+                    if want_summary:
+                        futures[pool.submit(request_summarize_with_model, thinking_buffered, MAX_NEW_TOKENS_SUMMARIZE, cancel)] = "summarizer"
+                    fallback_errors = []
+                    for fut in as_completed(futures):
+                        try:
+                            result = fut.result()
+                        except Exception as e:
+                            print(f"⚠️ {futures[fut]} call failed: {e}")
+                            fallback_errors.append(f"{futures[fut]}: {e}")
+                            continue
+                        if not result:
+                            continue
+                        if futures[fut] == "finish":
                             # treat the entire finished text as final if no label
-                            final_buffered = finished.strip()
-                        final_source = f"finish (attempt {attempt})"
+                            _, parsed_final = parse_thinking_and_final(result)
+                            final_buffered = parsed_final or result.strip()
+                            final_source = "finish"
+                        else:
+                            final_buffered = result
+                            final_source = "summarizer"
                         break
-                    else:
-                        # increment tokens and try again
-                        current_tokens += tokens_increment
-                        attempt += 0  # just continue
-                # end while
-        # end finish attempts
-
-        # 2) If still no final, optional summarizer
-        if not final_buffered:
-            use_model_summarizer = st.session_state.get("ui_model_summarize", True)
-            if use_model_summarizer and thinking_buffered:
-                # indicate summarizer is running
-                badge_html = '<span class="badge">source: summarizer</span>'
-                thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking</div>'
-                thinking_html += f'<div class="thinking-body">{markdown.markdown(thinking_buffered or "", extensions=["fenced_code","codehilite"])}</div></div>'
-                final_preview = f'<div class="final-card"><div><strong>Final Answer</strong>{badge_html}</div><div style="margin-top:8px">summarizing...</div></div>'
-                stream_ph.markdown(thinking_html + final_preview, unsafe_allow_html=True)
-
-                synthesized = request_summarize_with_model(thinking_buffered, max_new_tokens=MAX_NEW_TOKENS_SUMMARIZE)
-                if synthesized:
-                    final_buffered = synthesized
-                    final_source = "summarizer"
-
-        # 3) Fallback heuristic
-        if not final_buffered:
-            if thinking_buffered:
-                sentences = re.split(r'(?<=[.!?])\s+', thinking_buffered.strip())
-                sentences = [s.strip() for s in sentences if s.strip()]
-                final_buffered = " ".join(sentences[-2:]) if sentences else (thinking_buffered.strip()[:512] + "...")
-            else:
-                final_buffered = "No response generated by model."
-            final_source = final_source if 'final_source' in locals() else "heuristic"
+                    # don't wait for the slower call: it drops its stream on the next event,
+                    # which disconnects it and cancels its job on the backend
+                    cancel.set()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    if not final_buffered and fallback_errors:
+                        with turns:
+                            st.warning("Fallback calls failed: " + "; ".join(fallback_errors))
+
+            # 3) Fallback heuristic
+            if not final_buffered:
+                if thinking_buffered:
+                    sentences = _SENTENCE_SPLIT_RE.split(thinking_buffered.strip())
+                    sentences = [s.strip() for s in sentences if s.strip()]
+                    final_buffered = " ".join(sentences[-2:]) if sentences else (thinking_buffered.strip()[:512] + "...")
+                else:
+                    final_buffered = "No response generated by model."
+                final_source = final_source if 'final_source' in locals() else "heuristic"
 
-        # Final UI update: show thinking + final with badge showing source
-        badge_html = f'<span class="badge">source: {final_source}</span>'
-        if finish_attempts > 0 and final_source.startswith("finish"):
-            badge_html += f'<span class="counter">tries: {finish_attempts}</span>'
+            # Final UI update: show thinking + final with badge showing source
+            badge_html = f'<span class="badge">source: {final_source}</span>'
+            if finish_attempts > 0 and final_source.startswith("finish"):
+                badge_html += f'<span class="counter">tries: {finish_attempts}</span>'
 
-        thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking</div>'
-        thinking_html += f'<div class="thinking-body">{markdown.markdown(thinking_buffered or "", extensions=["fenced_code","codehilite"])}</div></div>'
-        final_html = f'<div class="final-card"><div><strong>Final Answer</strong>{badge_html}</div><div style="margin-top:8px">{markdown.markdown(final_buffered, extensions=["fenced_code","codehilite"])}</div></div>'
-        stream_ph.markdown(thinking_html + final_html, unsafe_allow_html=True)
+            thinking_html = '<div class="thinking-card"><div class="thinking-header">Thinking</div>'
+            thinking_html += f'<div class="thinking-body">{_render_md(thinking_buffered or "")}</div></div>'
+            final_html = f'<div class="final-card"><div><strong>Final Answer</strong>{badge_html}</div><div style="margin-top:8px">{_render_md(final_buffered)}</div></div>'
+            stream_ph.markdown(thinking_html + final_html, unsafe_allow_html=True)
 
-        # append assistant raw buffer (for traceability) to history
-        assistant_content_to_store = buffer.strip() or final_buffered
-        st.session_state.messages.append({"role":"assistant", "content": assistant_content_to_store})
+            # append assistant raw buffer (for traceability) to history
+            assistant_content_to_store = buffer.strip() or final_buffered
+            st.session_state.messages.append({"role":"assistant", "content": assistant_content_to_store})
+            # no st.rerun(): the fragment keeps this turn on screen, the history above is untouched
 
-        # Re-render the page so history is stable and input is bottom
-        st.rerun()
+        except Exception as e:
+            st.session_state.messages.append({"role":"assistant", "content": f"Streaming error: {e}"})
+            stream_ph.markdown(_plain_html(f"Streaming error: {e}"), unsafe_allow_html=True)
 
-    except Exception as e:
-        st.session_state.messages.append({"role":"assistant", "content": f"Streaming error: {e}"})
-        st.rerun()
+chat_input_fragment()
@@ -3,13 +3,26 @@
 # Fixed to handle backend "response" key, hide <think>, show thinking in an expander
 # and avoid StreamlitDuplicateElementId by giving widgets explicit keys.
 
+import importlib
 import json
 import re
+import threading
 import time
+import uuid
 from typing import Dict, Generator, List, Optional
 
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+
+# Fastest available JSON parser: orjson > ujson > stdlib (all accept bytes).
+for _name in ("orjson", "ujson", "json"):
+    try:
+        _json = importlib.import_module(_name)
+        break
+    except ImportError:
+        pass
+_loads = _json.loads
 
 # ===== Required constants (keep EXACT) =====
 API_URL = "http://127.0.0.1:8001/chat"   # keep exact
@@ -19,6 +32,13 @@ MODEL_NAME = "Qwen"
 # ==========================================
 
 DISPLAY_NAME = "QwenMLP-LocalGPT model"   # App-facing name only
+UPDATE_MIN_CHUNKS = 8                     # also require this many new chunks per UI flush
+
+# Persistent connection pool, so new messages / regenerates reuse the socket.
+_SESSION = requests.Session()
+_SESSION.trust_env = False   # local backend: skip the per-request proxy/netrc env lookup
+# Room for a few concurrent streams (e.g. several browser tabs) without dropping sockets.
+_SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
 
 # -------- Helpers --------
@@ -46,78 +66,167 @@ You are a helpful, concise assistant. Answer clearly and directly.   """
         }
     if "last_user" not in st.session_state:
         st.session_state.last_user: Optional[str] = None
-    if "stop_requested" not in st.session_state:
-        st.session_state.stop_requested = False
+    if "_stop_event" not in st.session_state:
+        # the stream loop holds a local reference and the Stop button sets it
+        # (no session_state lookup per chunk; safe if the stream moves to a thread)
+        st.session_state._stop_event = threading.Event()
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "_chat_export_ver" not in st.session_state:
+        st.session_state._chat_export_ver = 0
 
 
-def _extract_content_from_json(data: dict) -> Optional[str]:
+def _extract_content_from_json(data) -> Optional[str]:
     """
     Handle common response shapes.
     """
-    try:
-        if "choices" in data and data["choices"]:
-            ch0 = data["choices"][0]
-            if "delta" in ch0 and "content" in ch0["delta"]:
-                return ch0["delta"]["content"]
-            if "message" in ch0 and "content" in ch0["message"]:
-                return ch0["message"]["content"]
-
-        # Local backends often return "response" or "generated_text"
-        for k in ("content", "text", "token", "response", "generated_text"):
-            if k in data and isinstance(data[k], str):
-                return data[k]
-    except Exception:
-        pass
+    if not isinstance(data, dict):
+        return None
+    # Fast path for this backend's non-OpenAI shape: {"response": "..."}
+    response = data.get("response")
+    if isinstance(response, str):
+        return response
+
+    choices = data.get("choices")
+    if isinstance(choices, list) and choices:
+        ch0 = choices[0]
+        if isinstance(ch0, dict):
+            delta = ch0.get("delta")
+            if isinstance(delta, dict) and isinstance(delta.get("content"), str):
+                return delta["content"]
+            msg = ch0.get("message")
+            if isinstance(msg, dict) and isinstance(msg.get("content"), str):
+                return msg["content"]
+
+    # Local backends often return "response" (checked above) or "generated_text"
+    for k in ("content", "text", "token", "generated_text"):
+        v = data.get(k)
+        if isinstance(v, str):
+            return v
     return None
 
 
-def _clean_response(text: str) -> str:
-    """Keep only content after </think> and strip whitespace."""
-    # If </think> exists, drop everything before it
-    if "</think>" in text:
-        return text.split("</think>", 1)[1].strip()
-    return text.strip()
-
+class ThinkSplitter:
+    """
+    Incremental <think>/</think> splitter: each chunk is scanned once with str.find
+    for the tag expected next; a tag split across two chunks is held back until
+    the next chunk completes it.
+    """
 
-def _parse_stream_line(line: str) -> Optional[str]:
-    """Parse raw SSE or JSON lines into text chunks."""
+    _TAGS = ("<think>", "</think>")
+
+    def __init__(self, in_think: bool = True):
+        self.in_think = in_think  # Qwen thinking templates open <think> in the prompt
+        self.saw_close = False
+        self.think_buf: List[str] = []
+        self.after_buf: List[str] = []
+        self._carry = ""
+
+    def feed(self, chunk: str) -> str:
+        """Consume one chunk; return the part of it that is outside <think> blocks."""
+        text = self._carry + chunk if self._carry else chunk
+        self._carry = ""
+        visible: List[str] = []
+        while text:
+            tag = "</think>" if self.in_think else "<think>"
+            i = text.find(tag)
+            if i < 0:
+                keep = self._partial_tag_len(text)
+                if keep:
+                    self._carry = text[-keep:]
+                    text = text[:-keep]
+                self._emit(text, visible)
+                break
+            self._emit(text[:i], visible)
+            text = text[i + len(tag):]
+            self.saw_close = self.saw_close or self.in_think
+            self.in_think = not self.in_think
+        return "".join(visible)
+
+    def flush(self) -> str:
+        """End of stream: a held-back partial tag is plain text after all."""
+        text, self._carry = self._carry, ""
+        visible: List[str] = []
+        self._emit(text, visible)
+        return "".join(visible)
+
+    def think_text(self) -> str:
+        return self._joined(self.think_buf)
+
+    def after_text(self) -> str:
+        return self._joined(self.after_buf)
+
+    @staticmethod
+    def _joined(buf: List[str]) -> str:
+        # Collapse the parts into one cached string, so the next flush joins that
+        # string with only the chunks that arrived since.
+        if len(buf) > 1:
+            buf[:] = ["".join(buf)]
+        return buf[0] if buf else ""
+
+    def _emit(self, text: str, visible: List[str]):
+        if not text:
+            return
+        if self.in_think:
+            # a stray opening tag while already thinking is just dropped
+            self.think_buf.append(text.replace("<think>", ""))
+        else:
+            self.after_buf.append(text)
+            visible.append(text)
+
+    def _partial_tag_len(self, text: str) -> int:
+        """Length of a trailing prefix of <think>/</think> (0 if none)."""
+        i = text.rfind("<", max(0, len(text) - len("</think>")))
+        if i < 0:
+            return 0
+        tail = text[i:]
+        return len(tail) if any(t.startswith(tail) for t in self._TAGS) else 0
+
+
+def _parse_stream_line(line: bytes) -> Optional[str]:
+    """Parse raw SSE or JSON lines (undecoded bytes) into text chunks."""
     if not line:
         return None
-    if line.startswith("data:"):
-        line = line[5:].strip()
-    if line.strip() == "[DONE]":
+    # index arithmetic instead of startswith/strip copies; slice once at the end
+    i = 5 if line[:5] == b"data:" else 0
+    n = len(line)
+    while i < n and line[i] == 0x20:  # skip spaces after "data:"
+        i += 1
+    if line.startswith(b"[DONE]", i):
         return None
+    payload = line[i:] if i else line
+    # Only JSON objects/arrays go through the parser; bare tokens skip the try/except.
+    if i == n or line[i] not in b"{[":
+        return payload.decode("utf-8", "replace")
     try:
-        obj = json.loads(line)
+        obj = _loads(payload)
+        if isinstance(obj, dict) and obj.get("error"):
+            # the backend reports a failed generation as {"error": "..."}
+            return f"\n\n**[Backend error]** {obj['error']}"
         return _extract_content_from_json(obj)
     except Exception:
-        return line  # fallback: bare text
+        return payload.decode("utf-8", "replace")  # fallback: bare text
 
 
-def _extract_think_and_after(full_text: str) -> (str, str):
-    """
-    Given the cumulative assembled stream text, return a tuple:
-    (thinking_text, after_think_text)
-    - thinking_text: everything between an opening <think> (if present) and the first </think> (or the whole text if </think> not seen).
-    - after_think_text: text after the first </think> if present, otherwise empty string.
-    """
-    text = full_text or ""
-    # remove a single leading <think> if present
-    if "<think>" in text and "</think>" in text:
-        before, after = text.split("</think>", 1)
-        before = before.split("<think>", 1)[-1]  # remove anything before/including first <think>
-        return before, after
-    elif "<think>" in text and "</think>" not in text:
-        # still inside thinking section
-        after_open = text.split("<think>", 1)[1]
-        return after_open, ""
-    elif "</think>" in text and "<think>" not in text:
-        # unexpected: closing without opening - treat everything before closing as thinking
-        before, after = text.split("</think>", 1)
-        return before, after
-    else:
-        # no thinking markers at all -> treat as thinking interim (until we see a closing marker)
-        return text, ""
+def _iter_raw_lines(resp, chunk_size: int = 8192) -> Generator[bytes, None, None]:
+    """Split a streamed body into undecoded lines; bigger reads than iter_lines' 512 B."""
+    buf = bytearray()
+    for data in resp.iter_content(chunk_size=chunk_size):
+        buf += data
+        start = 0
+        while (nl := buf.find(b"\n", start)) != -1:
+            yield bytes(buf[start:nl]).rstrip(b"\r")
+            start = nl + 1
+        del buf[:start]
+    if buf:
+        yield bytes(buf).rstrip(b"\r")
+
+
+def _dumps(obj) -> bytes:
+    """Compact UTF-8 JSON bytes (request bodies, export button)."""
+    if _json.__name__ == "orjson":
+        return _json.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
 def stream_chat_completion(
@@ -127,6 +236,7 @@ def stream_chat_completion(
     max_tokens: int,
     seed: Optional[int],
     stream: bool,
+    session_id: Optional[str] = None,
 ) -> Generator[str, None, None]:
     """POST to API_URL and yield chunks if streaming, otherwise yield final text."""
     payload = {
@@ -139,25 +249,32 @@ def stream_chat_completion(
     }
     if seed is not None and seed != "":
         payload["seed"] = seed
-
-    headers = {"Content-Type": "application/json"}
+    if session_id:
+        payload["session_id"] = session_id
+
+    # Pre-serialized so requests' stdlib json.dumps never runs on the history.
+    body = _dumps(payload)
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": str(len(body)),
+        "Connection": "keep-alive",
+    }
 
     try:
-        with requests.post(
+        with _SESSION.post(
             API_URL,
             headers=headers,
-            json=payload,
+            data=body,
             stream=True,
             timeout=STREAM_TIMEOUT,
         ) as resp:
             resp.raise_for_status()
             if stream:
-                for raw in resp.iter_lines(decode_unicode=True):
-                    if st.session_state.get("stop_requested"):
+                stop_event = st.session_state._stop_event
+                for line in _iter_raw_lines(resp):
+                    if stop_event.is_set():
                         break
-                    if raw is None:
-                        continue
-                    chunk = _parse_stream_line(raw)
+                    chunk = _parse_stream_line(line)
                     if chunk:
                         yield chunk
             else:
@@ -169,19 +286,102 @@ def stream_chat_completion(
         yield f"**[Connection error]** {e}"
 
 
+def _visible_chunks(chunks, splitter: ThinkSplitter, thinking_area, placeholder, status: dict):
+    """
+    Feed for st.write_stream: yields only text outside <think> blocks.
+    Every chunk goes through the splitter; the thinking expander is refreshed on a
+    throttle and status["thinking_shown"] records the last text rendered into it.
+    """
+    last_flush = 0.0
+    n_chunks = 0
+    last_flushed = 0
+    started = False
+    for chunk in chunks:
+        n_chunks += 1
+        text = splitter.feed(chunk)
+        if text:
+            if not started:
+                placeholder.empty()  # drop the "Thinking…" line once real text arrives
+                started = True
+            yield text
+
+        now = time.perf_counter()
+        if now - last_flush >= UPDATE_THROTTLE_SEC and n_chunks - last_flushed >= UPDATE_MIN_CHUNKS:
+            thinking_text = splitter.think_text().strip()
+            thinking_area.markdown(thinking_text or "_(no internal thinking captured yet)_")
+            status["thinking_shown"] = thinking_text
+            last_flush = now
+            last_flushed = n_chunks
+    tail = splitter.flush()
+    if tail:
+        yield tail
+
+
 def render_message(role: str, content: str):
     with st.chat_message(role):
         st.markdown(content)
 
 
+def _touch_history():
+    """Mark `messages` as changed so the cached export blob and history block are rebuilt."""
+    st.session_state._chat_export_ver += 1
+    st.session_state.pop("_rendered_history", None)
+
+
+def _export_ready() -> bool:
+    cached = st.session_state.get("_chat_export_cache")
+    return cached is not None and cached[0] == st.session_state._chat_export_ver
+
+
+def _export_bytes() -> bytes:
+    """Export blob cached per session, re-serialized only after the history changes."""
+    ver = st.session_state._chat_export_ver
+    cached = st.session_state.get("_chat_export_cache")
+    if cached is None or cached[0] != ver:
+        cached = (ver, _dumps(st.session_state.messages))
+        st.session_state._chat_export_cache = cached
+    return cached[1]
+
+
+LIVE_TAIL_MESSAGES = 2   # most recent messages rendered as individual chat bubbles
+
+
+def _history_block(messages: List[Dict[str, str]]) -> str:
+    """One markdown document for older turns, so history replay is a single element."""
+    blocks = []
+    for m in messages:
+        who = "🧑 **You**" if m["role"] == "user" else f"🤖 **{DISPLAY_NAME}**"
+        content = m["content"]
+        if content.count("```") % 2:
+            content += "\n```"  # don't let an unclosed fence swallow later turns
+        blocks.append(f"{who}\n\n{content}")
+    return "\n\n---\n\n".join(blocks)
+
+
+def render_history():
+    messages = st.session_state.messages
+    split = max(len(messages) - LIVE_TAIL_MESSAGES, 0)
+    if split:
+        cached = st.session_state.get("_rendered_history")
+        if cached is None or cached[0] != split:
+            cached = (split, _history_block(messages[:split]))
+            st.session_state._rendered_history = cached
+        st.markdown(cached[1])
+    for msg in messages[split:]:
+        render_message(msg["role"], msg["content"])
+
+
 def add_to_history(role: str, content: str):
     st.session_state.messages.append({"role": role, "content": content})
+    _touch_history()
 
 
 def reset_chat():
     st.session_state.messages = []
+    _touch_history()
     st.session_state.last_user = None
-    st.session_state.stop_requested = False
+    st.session_state._stop_event.clear()
+    st.session_state.session_id = uuid.uuid4().hex
 
 
 # -------- App UI --------
@@ -225,21 +425,25 @@ with st.sidebar:
             st.rerun()
     with colB:
         if st.button("⏹️ Stop", type="secondary", use_container_width=True, key="stop_btn"):
-            st.session_state.stop_requested = True
+            st.session_state._stop_event.set()
 
     st.divider()
-    export = st.download_button(
-        "⬇️ Export chat (JSON)",
-        data=json.dumps(st.session_state.messages, ensure_ascii=False, indent=2),
-        file_name="chat_history.json",
-        mime="application/json",
-        use_container_width=True,
-        key="export_btn",
-    )
+    # Serialize only on request; the blob then stays valid until the history changes.
+    if _export_ready() or st.button("📦 Prepare export", use_container_width=True, key="prepare_export_btn"):
+        export = st.download_button(
+            "⬇️ Export chat (JSON)",
+            data=_export_bytes(),
+            file_name="chat_history.json",
+            mime="application/json",
+            use_container_width=True,
+            key="export_btn",
+        )
     uploaded = st.file_uploader("⬆️ Import chat (JSON)", type=["json"], key="import_uploader")
     if uploaded:
         try:
-            st.session_state.messages = json.load(uploaded)
+            # older exports carried the system prompt inline; it now lives in system_prompt
+            st.session_state.messages = [m for m in _loads(uploaded.getvalue()) if m.get("role") != "system"]
+            _touch_history()
             st.success("Chat imported.")
         except Exception as e:
             st.error(f"Import failed: {e}")
@@ -256,70 +460,58 @@ st.markdown(
 )
 st.caption("Chat interface with streaming, history, and tunable parameters.")
 
-# Ensure system prompt is first message
-if st.session_state.system_prompt:
-    if not st.session_state.messages or st.session_state.messages[0]["role"] != "system":
-        st.session_state.messages.insert(0, {"role": "system", "content": st.session_state.system_prompt})
-    else:
-        st.session_state.messages[0]["content"] = st.session_state.system_prompt
-
-# Render existing history
-for msg in st.session_state.messages:
-    if msg["role"] == "system":
-        continue
-    render_message(msg["role"], msg["content"])
+# Render existing history (the system prompt is kept out of `messages`)
+render_history()
 
 # Chat input
 user_prompt = st.chat_input(f"Message {DISPLAY_NAME}…", key="chat_input")
 if user_prompt:
-    st.session_state.stop_requested = False
+    mp = st.session_state.model_params
+    st.session_state._stop_event.clear()
     st.session_state.last_user = user_prompt
 
     add_to_history("user", user_prompt)
     render_message("user", user_prompt)
 
     with st.chat_message("assistant"):
-        placeholder = st.empty()             # visible answer area
+        answer_box = st.container()          # visible answer area (st.write_stream renders here)
+        placeholder = answer_box.empty()
         thinking_expander = st.expander("Internal thinking (click to expand)", expanded=False)
         thinking_area = thinking_expander.empty()  # placeholder inside the expander
-        assembled = ""
-        last_flush = 0.0
+        splitter = ThinkSplitter()      # incremental think/answer split of the stream
+        status = {"thinking_shown": None}
 
         # Initially show a single small thinking line in main area
         placeholder.markdown("_Thinking…_")
 
         msg_payload = st.session_state.messages
-        for chunk in stream_chat_completion(
+        if st.session_state.system_prompt:
+            msg_payload = [{"role": "system", "content": st.session_state.system_prompt}] + msg_payload
+        chunks = stream_chat_completion(
             messages=msg_payload,
-            temperature=st.session_state.model_params["temperature"],
-            top_p=st.session_state.model_params["top_p"],
-            max_tokens=st.session_state.model_params["max_tokens"],
-            seed=st.session_state.model_params["seed"],
-            stream=st.session_state.model_params["stream"],
-        ):
-            assembled += chunk
-            # derive current thinking vs visible parts
-            thinking_text, after_think_text = _extract_think_and_after(assembled)
-
-            now = time.perf_counter()
-            if now - last_flush >= UPDATE_THROTTLE_SEC:
-                # Update the internal thinking expander (strip leading/trailing whitespace)
-                thinking_display = thinking_text.strip() or "_(no internal thinking captured yet)_"
-                thinking_area.markdown(thinking_display)
-
-                # Update main visible area with anything emitted after </think>
-                if after_think_text.strip():
-                    placeholder.markdown(after_think_text.strip())
-                else:
-                    # still thinking — keep temporary line until we have real visible text
-                    placeholder.markdown("_Thinking…_")
-                last_flush = now
-
-        # finished streaming (or non-stream)
-        final_text = _clean_response(assembled.strip())
-        # Ensure the expander shows the full thinking content (strip tags)
-        final_think, _ = _extract_think_and_after(assembled)
-        thinking_area.markdown(final_think.strip() or "_(no internal thinking)_")
-
-        placeholder.markdown(final_text if final_text else "_(no content)_")
+            temperature=mp["temperature"],
+            top_p=mp["top_p"],
+            max_tokens=mp["max_tokens"],
+            seed=mp["seed"],
+            stream=mp["stream"],
+            session_id=st.session_state.session_id,
+        )
+        with answer_box:
+            st.write_stream(_visible_chunks(chunks, splitter, thinking_area, placeholder, status))
+
+        # finished streaming (or non-stream): think blocks were already split off while streaming
+        final_think = splitter.think_text().strip()
+        if splitter.saw_close:
+            final_text = splitter.after_text().strip()
+        else:
+            # no </think> at all -> the whole reply is the answer (nothing was streamed visibly)
+            final_text = final_think
+            placeholder.markdown(final_text if final_text else "_(no content)_")
+        # Ensure the expander shows the full thinking content,
+        # unless the last throttled flush already rendered exactly this text
+        if not final_think or final_think != status["thinking_shown"]:
+            thinking_area.markdown(final_think or "_(no internal thinking)_")
+
+        if splitter.saw_close and not final_text:
+            placeholder.markdown("_(no content)_")
     add_to_history("assistant", final_text)
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import sys
+from dataclasses import dataclass
+from typing import Optional
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("msgspec")
+pytest.importorskip("mlx_lm")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from backend import app as backend  # noqa: E402
+
+
+class FakeDetokenizer:
+    """Mirrors mlx_lm's streaming detokenizers: reading last_segment consumes it."""
+
+    def reset(self):
+        self.text = ""
+        self.offset = 0
+
+    def add_token(self, token):
+        self.text += chr(token)
+
+    def finalize(self):
+        pass
+
+    @property
+    def last_segment(self):
+        seg = self.text[self.offset:]
+        self.offset = len(self.text)
+        return seg
+
+
+class FakeTokenizer:
+    eos_token_ids = {0}
+
+    def __init__(self):
+        self.detokenizer = FakeDetokenizer()
+
+
+@dataclass
+class Response:
+    uid: int
+    token: int
+    finish_reason: Optional[str]
+
+
+class FakeBatchGenerator:
+    """Echoes each prompt back one token per step, then finishes with "length".
+
+    Mirrors mlx_lm>=0.32: next() returns (prompt_responses, generation_responses),
+    stop_tokens are sequences, and close() must be called when done.
+    """
+
+    fail_insert = False
+    closed = 0
+
+    def __init__(self, model, stop_tokens=None, completion_batch_size=None):
+        assert all(isinstance(seq, list) for seq in stop_tokens or [])
+        self.pending = {}
+        self.next_uid = 0
+
+    def insert(self, prompts, max_tokens):
+        if self.fail_insert:
+            raise RuntimeError("insert failed")
+        uids = []
+        for prompt in prompts:
+            self.pending[self.next_uid] = list(prompt)
+            uids.append(self.next_uid)
+            self.next_uid += 1
+        return uids
+
+    def remove(self, uids):
+        for uid in uids:
+            self.pending.pop(uid, None)
+
+    def next(self):
+        out = []
+        for uid, toks in list(self.pending.items()):
+            tok = toks.pop(0)
+            out.append(Response(uid, tok, None if toks else "length"))
+            if not toks:
+                del self.pending[uid]
+        return [], out
+
+    def next_generated(self):
+        return self.next()[1]
+
+    def close(self):
+        FakeBatchGenerator.closed += 1
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    monkeypatch.setattr(backend, "tokenizer", FakeTokenizer())
+    monkeypatch.setattr(backend, "model", object())
+    monkeypatch.setattr(backend, "BatchGenerator", FakeBatchGenerator)
+    monkeypatch.setattr(FakeBatchGenerator, "fail_insert", False)
+    monkeypatch.setattr(FakeBatchGenerator, "closed", 0)
+
+
+def _run_batch(prompts):
+    """Run ContinuousBatcher.run on a worker thread; return what each job received."""
+    async def main():
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue()
+        jobs = [backend.Job(prompt, max_tokens=len(prompt)) for prompt in prompts]
+        await loop.run_in_executor(None, backend.ContinuousBatcher(loop, q).run, jobs)
+        await asyncio.sleep(0)  # let the call_soon_threadsafe pushes land
+        received = []
+        for job in jobs:
+            items = []
+            while not job.resp_q.empty():
+                items.append(job.resp_q.get_nowait())
+            received.append(items)
+        return received
+
+    return asyncio.run(main())
+
+
+def test_batcher_streams_each_jobs_text(fakes):
+    received = _run_batch([[ord(c) for c in "hello"], [ord(c) for c in "hi"]])
+    assert ["".join(items[:-1]) for items in received] == ["hello", "hi"]
+    assert all(items[-1] is None for items in received)
+    assert all(items[:-1] and all(items[:-1]) for items in received)  # no empty pushes
+
+
+def test_batcher_fails_jobs_when_insert_raises(fakes, monkeypatch):
+    monkeypatch.setattr(FakeBatchGenerator, "fail_insert", True)
+    received = _run_batch([[ord("a")], [ord("b")]])
+    for items in received:
+        assert isinstance(items[0], RuntimeError)
+        assert items[-1] is None
+    assert FakeBatchGenerator.closed == 1
+
+
+def test_batcher_runs_on_real_batch_generator(fakes, monkeypatch):
+    """Drive run() through mlx_lm's own BatchGenerator (tiny random Qwen3) and its response shape."""
+    import mlx.core as mx
+    from mlx_lm.generate import BatchGenerator
+    from mlx_lm.models import qwen3
+
+    mx.random.seed(0)
+    args = qwen3.ModelArgs(
+        model_type="qwen3", hidden_size=32, num_hidden_layers=1, intermediate_size=64,
+        num_attention_heads=2, rms_norm_eps=1e-6, vocab_size=128, num_key_value_heads=1,
+        max_position_embeddings=128, head_dim=16, tie_word_embeddings=True, rope_theta=10000.0,
+    )
+    model = qwen3.Model(args)
+    mx.eval(model.parameters())  # lazy arrays can only be evaluated on the thread that made them
+    monkeypatch.setattr(backend, "model", model)
+    monkeypatch.setattr(backend, "BatchGenerator", BatchGenerator)
+    received = _run_batch([[ord(c) for c in "hello"], [ord(c) for c in "hi"]])
+    for items in received:
+        assert items[-1] is None
+        assert not any(isinstance(item, Exception) for item in items), items
+        assert all(isinstance(item, str) for item in items[:-1])
+
+
+@pytest.mark.parametrize(
+    "stream, expected",
+    [(True, True), (False, False), (1, True), (0, False), (None, False),
+     ("true", True), ("True", True), ("1", True), ("false", False), ("0", False), ("", False)],
+)
+def test_parse_chat_request_stream_flag(stream, expected):
+    raw = backend.msgspec.json.encode({"messages": [], "stream": stream})
+    assert backend._parse_chat_request(raw).stream is expected
+
+
+@pytest.mark.parametrize("stream", ["maybe", [True], {"on": True}])
+def test_parse_chat_request_rejects_bad_stream_flag(stream):
+    raw = backend.msgspec.json.encode({"messages": [], "stream": stream})
+    with pytest.raises(backend.HTTPException) as exc:
+        backend._parse_chat_request(raw)
+    assert exc.value.status_code == 422
+
+
+def test_collect_batch_returns_session_job_without_waiting(monkeypatch):
+    monkeypatch.setattr(backend, "MAX_BATCH_DELAY", 10)
+
+    async def main():
+        q = asyncio.Queue()
+        q.put_nowait(backend.Job([1], max_tokens=1, session_id="s"))
+        return await asyncio.wait_for(backend._collect_batch(q), timeout=1)
+
+    jobs = asyncio.run(main())
+    assert [job.session_id for job in jobs] == ["s"]
+
+
+def test_batcher_skips_event_loop_when_queue_is_empty(fakes, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("hopped to the event loop with nothing queued")
+
+    monkeypatch.setattr(backend.asyncio, "run_coroutine_threadsafe", fail)
+    received = _run_batch([[ord(c) for c in "hey"]])
+    assert "".join(received[0][:-1]) == "hey"
+
+
+def test_collect_batch_stops_when_a_session_job_arrives(monkeypatch):
+    monkeypatch.setattr(backend, "MAX_BATCH_DELAY", 10)
+
+    async def main():
+        q = asyncio.Queue()
+        q.put_nowait(backend.Job([1], max_tokens=1))
+        q.put_nowait(backend.Job([2], max_tokens=1, session_id="s"))
+        q.put_nowait(backend.Job([3], max_tokens=1))
+        return await asyncio.wait_for(backend._collect_batch(q), timeout=1)
+
+    jobs = asyncio.run(main())
+    assert [job.session_id for job in jobs] == [None, "s"]
+
+
+def test_batcher_runs_session_job_without_draining_the_batch(fakes, monkeypatch):
+    batch_pushes = []
+    session_started_after = []
+
+    def fake_run_generation(loop, job):
+        session_started_after.append(len(batch_pushes))
+        loop.call_soon_threadsafe(job.resp_q.put_nowait, "ok")
+        loop.call_soon_threadsafe(job.resp_q.put_nowait, None)
+
+    monkeypatch.setattr(backend, "_run_generation", fake_run_generation)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        q = asyncio.Queue()
+        batch_job = backend.Job([ord(c) for c in "abcdef"], max_tokens=6)
+        session_job = backend.Job([1], max_tokens=1, session_id="s")
+        q.put_nowait(session_job)
+        batcher = backend.ContinuousBatcher(loop, q)
+        push = batcher.push
+
+        def recording_push(job, item):
+            if job is batch_job:
+                batch_pushes.append(item)
+            push(job, item)
+
+        batcher.push = recording_push
+        await loop.run_in_executor(None, batcher.run, [batch_job])
+        await asyncio.sleep(0)
+        return session_job.resp_q.get_nowait()
+
+    assert asyncio.run(main()) == "ok"
+    assert session_started_after == [1]  # after one batch step, not after the drain
+    assert "".join(batch_pushes[:-1]) == "abcdef"